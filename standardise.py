@@ -1,5 +1,119 @@
+import mmap
+import os
+import shutil
+import tempfile
+from collections import defaultdict
+from multiprocessing import Pool
+
 from rdkit import Chem
-from standardiser.neutralise import run as neutralise
+from rdkit.Chem import rdMolDescriptors
+from rdkit.Chem.MolStandardize import rdMolStandardize
+from standardiser.neutralise import run as atkinson_neutralise
+from standardiser.utils import StandardiseException
+
+
+# salt metals li, Na, Mg, K, Ca not bound to more than one counter-ion. Ignore only for Mg and Ca!
+_SALT_METALS_SMARTS = "[Li,Na,K,Mg,Ca;D0,D1]"
+# everything apart from H, C, N, O, F, Si, P, S, Cl, Br, I
+_DISALLOWED_ATOMS_SMARTS = "[!#1;!#6;!#7;!#8;!#9;!#14;!#15;!#16;!#17;!#35;!#53]"
+_ORGANIC_ATOMS_SMARTS = "[#6,#14]"  # carbon or silicon
+
+_worker_standardiser = None  # standardiser of the current worker process, created by _init_worker
+
+
+def _init_worker(use_rdkit_uncharger):
+    """
+    Initialiser of the worker processes. Creates one standardiser per process instead of one per molecule.
+    """
+    global _worker_standardiser
+    _worker_standardiser = Standardization(use_rdkit_uncharger)
+
+
+def _standardise_one(mol_bytes):
+    """
+    Worker function for the process pool. Rebuilds the molecule from its binary, standardises it and returns the
+    result in binary form again, because RDKit molecules are transported cheaper that way than by pickling.
+    :param mol_bytes: binary of the molecule (including its properties) or None if the molecule could not be read
+    :return: Tuple indicating successful standardization and molecule binary or error message.
+    """
+    if mol_bytes is None:
+        return False, "Molecule could not be read"
+    ok, result = _worker_standardiser.standardise(Chem.Mol(mol_bytes))
+    if ok:
+        result = result.ToBinary(Chem.PropertyPickleOptions.AllProps)  # keep the properties of the input molecule
+    return ok, result
+
+
+def _sdf_shards(path, num_shards):
+    """
+    Splits an SDF file into byte ranges of about the same size. Every range starts at the beginning of a record,
+    i.e. right after a '$$$$' line, so the shards can be read independently.
+    :param path: path of the SDF file
+    :param num_shards: number of byte ranges to create
+    :return: list of (start, end) byte offsets
+    """
+    size = os.path.getsize(path)
+    if size == 0:
+        return []
+    starts = [0]
+    with open(path, "rb") as f, mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+        for i in range(1, num_shards):
+            pos = mm.find(b"$$$$", max(size * i // num_shards, starts[-1]))
+            while pos > 0 and mm[pos - 1:pos] != b"\n":  # '$$$$' must be at the start of a line
+                pos = mm.find(b"$$$$", pos + 4)
+            if pos == -1:  # no more records left to split
+                break
+            end_of_line = mm.find(b"\n", pos)
+            if end_of_line == -1 or end_of_line + 1 >= size:
+                break
+            starts.append(end_of_line + 1)
+    return list(zip(starts, starts[1:] + [size]))
+
+
+class _FileSlice:
+
+    """
+    Read-only stream over a byte range of a memory mapped file. Reads lazily, so a shard is never held in memory as a
+    whole.
+    """
+
+    def __init__(self, mm, start, end):
+        self._mm = mm
+        self._pos = start
+        self._end = end
+
+    def read(self, size=-1):
+        if size is None or size < 0 or self._pos + size > self._end:
+            size = self._end - self._pos
+        data = self._mm[self._pos:self._pos + size]
+        self._pos += len(data)
+        return data
+
+
+def _standardise_shard(args):
+    """
+    Worker function for the process pool. Reads the molecules of one byte range of an SDF file directly from disk and
+    writes the standardised ones to a separate SDF file -> no molecules are sent between the processes.
+    :param args: tuple of input path, start and end offset and output path of the shard
+    :return: Tuple of the number of read molecules and the list of (index in the shard, error message) pairs.
+    """
+    in_path, start, end, out_path = args
+    molcount = 0
+    errors = []
+    writer = Chem.SDWriter(out_path)
+    with open(in_path, "rb") as f, mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+        for mol in Chem.ForwardSDMolSupplier(_FileSlice(mm, start, end), sanitize=False, removeHs=False):
+            molcount += 1
+            if mol is None:
+                errors.append((molcount - 1, "Molecule could not be read"))
+                continue
+            ok, result = _worker_standardiser.standardise(mol)
+            if ok:
+                writer.write(result)
+            else:
+                errors.append((molcount - 1, result))
+    writer.close()
+    return molcount, errors
 
 
 class Standardization:
@@ -7,15 +121,33 @@ class Standardization:
     """
     Takes an input file and standardises the molecules obtained from the file.
 
-    Uses Atkinson's standardiser
+    Neutralises with RDKit's Uncharger or Atkinson's standardiser
     """
 
-    def __init__(self):
+    __slots__ = ("_use_rdkit_uncharger", "_uncharger", "_salt_pat", "_disallowed_pat", "_organic_pat")
+
+    def __init__(self, use_rdkit_uncharger=True):
         """
-        Create list of standardised molecules.
-        :ivar standardised_mol_list: list of standardised molecules
-        :param file: sdf file with the molecules
+        Prepare the neutralisation and the SMARTS queries used during standardisation.
+        :param use_rdkit_uncharger: neutralise with RDKit's Uncharger, otherwise with Atkinson's standardiser
         """
+        self._use_rdkit_uncharger = use_rdkit_uncharger
+        self._uncharger = rdMolStandardize.Uncharger(canonicalOrder=True) if use_rdkit_uncharger else None
+        self._salt_pat = Chem.MolFromSmarts(_SALT_METALS_SMARTS)
+        self._disallowed_pat = Chem.MolFromSmarts(_DISALLOWED_ATOMS_SMARTS)
+        self._organic_pat = Chem.MolFromSmarts(_ORGANIC_ATOMS_SMARTS)
+
+    def __getstate__(self):
+        """
+        Only keep the settings when pickling, the Uncharger cannot be pickled.
+        """
+        return (self._use_rdkit_uncharger,)  # tuple -> never empty, so __setstate__ is always called
+
+    def __setstate__(self, state):
+        """
+        Rebuild the Uncharger and the SMARTS queries after unpickling.
+        """
+        self.__init__(*state)
 
     def standardise(self, mol):
         """
@@ -23,7 +155,8 @@ class Standardization:
         Following functions are carried out:
             - Removing salts
             - Checking for possible components (might have been generated due to the salt removal)
-                - Remove duplicate components in the same molecule
+                - Remove duplicate components in the same molecule (valences are not checked strictly here -> a
+                component with an invalid valence only rejects the molecule if it is the one that is kept)
                 - Check for inorganic compounds and remove molecule if yes -> cannot be predicted
                 - Check for metals not forming salts in the molecule and remove molecule if yes -> cannot be predicted
                 - Get the largest component (by heavy atom count) if there are still more than one component.
@@ -36,48 +169,24 @@ class Standardization:
         :return: Tuple indicating successful standardization and molecule or error message.
         """
         mol = self.remove_salt_metals(mol)  # remove salt metals -> might produce some additional components
-        # check for mixtures
-        components = [c for c in Chem.GetMolFrags(mol, asMols=True,
-                                                sanitizeFrags=False)]  # gets the components of the given molecule
+        # check for mixtures -> only get the atom indices of the components, which is cheap
+        fragments = Chem.GetMolFrags(mol, asMols=False)
 
-        if len(components) > 1:  # handle mixtures
-            inorganic_frag = []
-            metal_frag = []
-            properties = mol.GetPropsAsDict()  # save original properties to assign later on to chosen component
+        if len(fragments) > 1:  # handle mixtures
+            # build the molecules of the components only now, single components are handled as they are
+            components = Chem.GetMolFrags(mol, asMols=True, sanitizeFrags=False)  # already a tuple, no copy needed
+            original = mol  # keep original molecule to assign its properties later on to chosen component
 
             try:
                 # remove duplicate components possibly obtained after removing salts
-                components = self.remove_duplicate_components(components)  # might fail due to neutralisation step
-            except:
-                return False, "Molecule could not be neutralised"
-
-            # flag inorganics
-            for comp_index in range(len(components)):  # iterate over the components
-                if self.is_inorganic(components[comp_index]):  # flag inorganic components
-                    inorganic_frag.append(comp_index)
-
-            # delete all inorganic components
-            if inorganic_frag:  # check if we even have inorganic parts
-                inorganic_frag.reverse()  # reverse so we don't mess up the indices
-                for comp_index in inorganic_frag:
-                    components.pop(comp_index)
-
-            # check if there is still more than 1 component.
+                components = self.remove_duplicate_components(components)  # might fail while generating SMILES
+            except (ValueError, RuntimeError, Chem.MolSanitizeException) as e:
+                return False, f"Duplicate components could not be removed: {e}"
+
+            # delete all inorganic and metal components in a single pass over the (deduplicated) components
             # Metals are considered as mixture, even though they are removed in the process
             # 'not used in online version -> just remove largest component'
-            # if len(components) > 1:
-            #     mixture.append(molecules[i])
-
-            # flag metals
-            for comp_index in range(len(components)):  # iterate over the components
-                if self.contains_metal(components[comp_index]):
-                    metal_frag.append(comp_index)
-
-            # remove all metal components
-            if metal_frag:  # check if we even have metals
-                metal_frag.reverse()
-                for comp_index in metal_frag:
-                    components.pop(comp_index)
+            components = [comp for comp in components if not self.is_inorganic(comp) and not self.contains_metal(comp)]
 
             # choose the remaining component to be our new molecule
             if len(components) > 1:  # check if there is still more than 1 component
@@ -87,8 +196,8 @@ class Standardization:
             else:  # no component left -> go on with the next molecule
                 return False, "Molecule contained only metals or inorganic compounds"
 
-            for prop, value in properties.items():  # assign properties to left over component
-                mol.SetProp(prop, str(value))
+            for prop in original.GetPropNames():  # assign properties to left over component
+                mol.SetProp(prop, original.GetProp(prop))  # copy the original text -> no conversion of numbers
 
         else:  # do cleaning for only one component
             if self.contains_metal(mol):
@@ -97,26 +206,86 @@ class Standardization:
                 return False, "Molecule is inorganic"
         try:
             # neutralise molecule
-            mol.UpdatePropertyCache()
-            mol = neutralise(mol)  # neutralisation might throw an error due to Sanity_check
+            mol.UpdatePropertyCache()  # strict -> rejects molecules with invalid valences
+            mol = self.neutralise(mol)  # neutralisation might throw an error due to Sanity_check
             return True, mol
-        except:
-            return False, "Molecule could not be neutralised"
+        except (StandardiseException, ValueError, RuntimeError, Chem.MolSanitizeException) as e:
+            return False, f"Molecule could not be neutralised: {e}"
+
+    def standardise_many(self, mols, processes=None, chunksize=64):
+        """
+        Standardises a batch of molecules in parallel using a pool of worker processes.
+        The order of the results corresponds to the order of the input molecules.
+        :param mols: iterable of molecules (None entries are reported as not readable)
+        :param processes: number of worker processes, defaults to the number of CPUs
+        :param chunksize: number of molecules sent to a worker at once
+        :return: List of tuples indicating successful standardization and molecule or error message.
+        """
+        # send binaries instead of molecules to the workers -> faster and smaller than pickling
+        mol_bytes = (None if m is None else m.ToBinary(Chem.PropertyPickleOptions.AllProps) for m in mols)
+        results = []
+        with Pool(processes, initializer=_init_worker, initargs=(self._use_rdkit_uncharger,)) as pool:
+            for ok, result in pool.imap(_standardise_one, mol_bytes, chunksize=chunksize):
+                results.append((ok, Chem.Mol(result) if ok else result))
+        return results
+
+    def standardise_sdf(self, in_path, out_path, processes=None):
+        """
+        Standardises all molecules of an SDF file in parallel and writes the standardised molecules to a new SDF file.
+        The file is split into one shard per process, each worker reads and writes its shard on its own and the
+        shards are concatenated in their original order afterwards.
+        :param in_path: path of the SDF file with the molecules
+        :param out_path: path of the SDF file the standardised molecules are written to
+        :param processes: number of worker processes, defaults to the number of CPUs
+        :return: Tuple of the number of read molecules and the list of (molecule index, error message) pairs.
+        """
+        processes = processes or os.cpu_count()
+        molcount = 0
+        errors = []
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            shards = [(in_path, start, end, os.path.join(tmp_dir, f"shard_{i}.sdf"))
+                      for i, (start, end) in enumerate(_sdf_shards(in_path, processes))]
+            if shards:  # empty file -> nothing to standardise, no pool needed
+                # small files might give fewer shards than processes -> don't start idle workers
+                with Pool(min(processes, len(shards)), initializer=_init_worker,
+                          initargs=(self._use_rdkit_uncharger,)) as pool:
+                    for shard_molcount, shard_errors in pool.map(_standardise_shard, shards):
+                        # indices of the shard start at 0 -> shift by the molecules of the previous shards
+                        errors.extend((molcount + index, message) for index, message in shard_errors)
+                        molcount += shard_molcount
+            with open(out_path, "wb") as out:
+                for shard in shards:
+                    with open(shard[3], "rb") as f:
+                        shutil.copyfileobj(f, out)
+        return molcount, errors
+
+    def neutralise(self, mol):
+        """
+        Neutralises the molecule with RDKit's Uncharger or, if chosen, with Atkinson's standardiser.
+        """
+        if self._uncharger is not None:
+            mol = self._uncharger.uncharge(mol)
+            # same sanity check as Atkinson's standardiser -> sanitized molecule, invalid ones raise
+            Chem.SanitizeMol(mol)
+            Chem.MolToSmiles(mol, isomericSmiles=True)
+            return mol
+        return atkinson_neutralise(mol)
 
     def is_silane(self, mol):
         """
         Checks if the molecule contains at least one carbon atom. If yes, the compound is considered to be organic (False).
         Otherwise the compound will be considered as inorganic and will be flagged as such (True).
         """
-        foundCarbon = False
-        foundSilicon = False
-        for a in list(mol.GetAtoms()):
-            if a.GetAtomicNum() == 14:  
-                foundSilicon = True
-            if a.GetAtomicNum() == 6: 
-                foundCarbon = True
-        if foundCarbon == True and foundSilicon == True:
-            return True
+        found_carbon = False
+        found_silicon = False
+        for a in mol.GetAtoms():
+            num = a.GetAtomicNum()
+            if num == 14:
+                found_silicon = True
+            elif num == 6:
+                found_carbon = True
+            if found_carbon and found_silicon:  # returns as soon as both were encountered
+                return True
         return False
 
     def is_inorganic(self, mol):
@@ -124,34 +293,23 @@ class Standardization:
         Checks if the molecule contains at least one carbon atom. If yes, the compound is considered to be organic (False).
         Otherwise the compound will be considered as inorganic and will be flagged as such (True).
         """
-        for a in list(mol.GetAtoms()):
-            if a.GetAtomicNum() == 6:  # returns upon the first carbon encounter -> we are not inorganic
-                return False
-            if a.GetAtomicNum() == 14:
-                return False
-        return True
+        return not mol.HasSubstructMatch(self._organic_pat)  # no carbon or silicon -> inorganic
 
 
     def remove_salt_metals(self, mol):
         """
         Removes the metals Li, Na, K, Mg, Ca from the molecule.
         """
-        salt_metals = [3, 11, 12, 19, 20]  # li, Na, Mg, K, Ca
-        to_remove = []  # maintain a list of atom indices which represent a metal
-
-        # iterate over atoms and search for salt metals
-        for a in list(mol.GetAtoms()):
-            if a.GetAtomicNum() in salt_metals:
-                if a.GetDegree() > 1:  # check if metal is bound to counter-ion -> ignore. Ignore only for Mg and Ca!
-                    continue
-                to_remove.append(a.GetIdx())  # only track the index, because molecule would change if we remove now
+        # only track the indices, because molecule would change if we remove now
+        to_remove = [match[0] for match in mol.GetSubstructMatches(self._salt_pat, maxMatches=mol.GetNumAtoms())]
 
         # remove in a separate step, because otherwise we mess up the atom order / index
         if to_remove:
-            mol = Chem.EditableMol(mol)
-            to_remove.reverse()  # start from the back to not alter the indices
+            mol = Chem.RWMol(mol)
+            mol.BeginBatchEdit()  # indices are only updated on commit -> order of removal does not matter
             for idx in to_remove:
                 mol.RemoveAtom(idx)
+            mol.CommitBatchEdit()
             mol = mol.GetMol()  # get a normal molecule back
         return mol
 
@@ -160,37 +318,41 @@ class Standardization:
         """
         Checks if the molecule contains a metal atom which we don't want.
         """
-        allowed_atoms = [1, 6, 7, 8, 9, 14, 15, 16, 17, 35, 53]
-        for a in list(mol.GetAtoms()):
-            if a.GetAtomicNum() not in allowed_atoms:  # returns upon encounter of the first not allowed atom
-                return True
-        return False
+        return mol.HasSubstructMatch(self._disallowed_pat)
 
 
     def get_largest_component(self, components):
         """
         Keep the component with the highest number of heavy atoms.
         """
-        largest_component = 0  # keep track of component index
-        num_atoms = 0  # keep track of component size
-        for i, comp in enumerate(components):
-            if comp.GetNumHeavyAtoms() > num_atoms:  # check if molecule has more heavy atoms. If the same, keep first
-                num_atoms = comp.GetNumHeavyAtoms()
-                largest_component = i  # udpate index of largest component
-        return components[largest_component]  # return largest component by index
+        # max returns the first index on ties -> if the same number of heavy atoms, keep first
+        return components[max(range(len(components)), key=lambda i: components[i].GetNumHeavyAtoms())]
 
 
     def remove_duplicate_components(self, components):
         """
-        Get a hash-code of the molecules and remove duplicate components.
+        Get the canonical SMILES of the molecules and remove duplicate components.
+        Stereochemistry is ignored, so stereoisomers count as duplicates.
+        Duplicates are detected after salt removal, but before neutralisation -> differently charged duplicates
+        are kept here and end up the same after the chosen component is neutralised.
+        The components are not sanitized, only their valences are computed. The chosen component is checked and
+        sanitized once during neutralisation.
         """
-        inchi_keys = {}
+        # group by a cheap key first -> SMILES are only generated for components which might be duplicates
+        buckets = defaultdict(list)
         for comp in components:
-            comp.UpdatePropertyCache()
-            comp = neutralise(comp)  # neutralise at this step to remove differently charged duplicates
-            inchi = Chem.inchi.MolToInchi(comp)
-            inchi_key = Chem.inchi.InchiToInchiKey(inchi)  # generate a hash code to filter by -> InChIKey
-
-            if inchi_key not in inchi_keys.keys():  # checks for duplicates
-                inchi_keys[inchi_key] = comp
-        return [comp for comp in inchi_keys.values()]  # returns all the unique fragments
\ No newline at end of file
+            comp.UpdatePropertyCache(strict=False)  # only compute valences, don't raise on unusual ones
+            buckets[(rdMolDescriptors.CalcMolFormula(comp), comp.GetNumHeavyAtoms())].append(comp)
+
+        unique = set()  # ids of the components to keep
+        for group in buckets.values():
+            if len(group) == 1:  # nothing else with the same formula -> cannot be a duplicate
+                unique.add(id(group[0]))
+                continue
+            unique_smiles = {}
+            for comp in group:
+                key = Chem.MolToSmiles(comp, isomericSmiles=False)  # canonical SMILES, much faster than InChI
+                if key not in unique_smiles:  # checks for duplicates
+                    unique_smiles[key] = comp
+                    unique.add(id(comp))
+        return [comp for comp in components if id(comp) in unique]  # returns all the unique fragments in input order
\ No newline at end of file
@@ -0,0 +1,104 @@
+import os
+import pickle
+
+from rdkit import Chem
+from rdkit.Chem import rdMolDescriptors
+
+from standardise import Standardization
+
+DATA_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "data")
+
+
+def test_standardise_keeps_property_text_of_mixtures():
+    mol = Chem.MolFromSmiles("CCCCO.Cl", sanitize=False)
+    mol.SetProp("acvalue", "0.1")
+    ok, result = Standardization().standardise(mol)
+    assert ok, result
+    assert result.GetProp("acvalue") == "0.1"
+
+
+def test_standardise_rejects_invalid_valence():
+    ok, result = Standardization().standardise(Chem.MolFromSmiles("CC(C)(C)(C)(C)C", sanitize=False))
+    assert not ok
+    assert result.startswith("Molecule could not be neutralised")
+
+
+def test_standardise_molecule_from_data():
+    stand = Standardization()
+    mol = next(m for m in Chem.ForwardSDMolSupplier(os.path.join(DATA_DIR, "BSEP_Univie.sdf"), sanitize=False)
+               if m is not None)
+    ok, result = stand.standardise(mol)
+    assert ok, result
+    assert result.GetNumAtoms() > 0
+
+
+def test_standardise_returns_sanitized_molecule():
+    ok, result = Standardization().standardise(Chem.MolFromSmiles("c1ccccc1C(=O)[O-]", sanitize=False))
+    assert ok, result
+    assert rdMolDescriptors.CalcNumAromaticRings(result) == 1
+    assert Chem.MolToSmiles(result) == "O=C(O)c1ccccc1"
+
+
+def test_standardise_rejects_invalid_structures():
+    for use_rdkit_uncharger in (True, False):
+        stand = Standardization(use_rdkit_uncharger)
+        for smiles in ("CC(C)(C)(C)(C)C", "c1cccc1"):
+            ok, _ = stand.standardise(Chem.MolFromSmiles(smiles, sanitize=False))
+            assert not ok, smiles
+
+
+def test_standardise_sdf_matches_sequential_standardise(tmp_path):
+    in_path = os.path.join(DATA_DIR, "Pgp_ChEMBL28.sdf")
+    stand = Standardization()
+    expected = []
+    expected_errors = []
+    for i, mol in enumerate(Chem.ForwardSDMolSupplier(in_path, sanitize=False)):
+        ok, result = stand.standardise(mol)
+        if ok:
+            expected.append(Chem.MolToSmiles(result))
+        else:
+            expected_errors.append((i, result))
+    out_path = str(tmp_path / "out.sdf")
+    molcount, errors = stand.standardise_sdf(in_path, out_path, processes=3)
+    assert molcount == len(expected) + len(expected_errors)
+    assert errors == expected_errors
+    assert [Chem.MolToSmiles(m) for m in Chem.ForwardSDMolSupplier(out_path)] == expected
+
+
+def test_standardise_sdf_empty_file(tmp_path):
+    in_path = tmp_path / "empty.sdf"
+    in_path.write_text("")
+    out_path = tmp_path / "out.sdf"
+    assert Standardization().standardise_sdf(str(in_path), str(out_path), processes=4) == (0, [])
+    assert out_path.read_text() == ""
+
+
+def test_standardise_ignores_invalid_valence_of_dropped_component():
+    ok, result = Standardization().standardise(Chem.MolFromSmiles("CCCCCCO.CC(C)(C)(C)(C)C", sanitize=False))
+    assert ok, result
+    assert Chem.MolToSmiles(result) == "CCCCCCO"
+
+
+def test_standardise_many_matches_sequential_standardise():
+    stand = Standardization()
+    mols = list(Chem.ForwardSDMolSupplier(os.path.join(DATA_DIR, "Pgp_ChEMBL28.sdf"), sanitize=False))
+    mols.insert(5, None)
+    expected = [(False, "Molecule could not be read") if m is None else stand.standardise(m) for m in mols]
+    results = stand.standardise_many(mols, processes=3, chunksize=16)
+    assert len(results) == len(expected)
+    for (ok, result), (expected_ok, expected_result) in zip(results, expected):
+        assert ok == expected_ok
+        if ok:
+            assert Chem.MolToSmiles(result) == Chem.MolToSmiles(expected_result)
+            assert result.GetPropsAsDict() == expected_result.GetPropsAsDict()
+        else:
+            assert result == expected_result
+
+
+def test_standardization_can_be_pickled():
+    mol = Chem.MolFromSmiles("CCCC(=O)[O-].[Na+]", sanitize=False)
+    for use_rdkit_uncharger in (True, False):
+        stand = pickle.loads(pickle.dumps(Standardization(use_rdkit_uncharger)))
+        ok, result = stand.standardise(Chem.Mol(mol))
+        assert ok, result
+        assert Chem.MolToSmiles(result) == "CCCC(=O)O"